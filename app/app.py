@@ -1,8 +1,11 @@
+import os
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import utils  
+import sketches
+import clustering
+# plotly (rendu) et reports (export groupé) sont importés plus bas, au premier usage :
+# la sidebar et l'invite de chargement s'affichent sans attendre ces modules lourds.
 
 # ---------------------------------------------------------
 # Config générale
@@ -28,12 +31,37 @@ uploaded_files = st.sidebar.file_uploader(
     accept_multiple_files=True 
 )
 
-if not uploaded_files:
-    st.warning("Veuillez importer le fichier pour commencer.")
-    st.stop()
-
-# Chargement via la fonction dans utils
-df_raw = utils.load_data(uploaded_files)
+if uploaded_files:
+    # Chargement via la fonction dans utils
+    df_raw = utils.load_data(uploaded_files)
+    # Identifiant du dataset pour les clés de cache des agrégats
+    dataset_key = tuple(file.file_id for file in uploaded_files)
+
+    # Snapshot disque pour rouvrir ce dataset au prochain démarrage (une fois par upload)
+    if st.session_state.get("snapshot_upload") != dataset_key:
+        try:
+            utils.save_snapshot(df_raw, [file.name for file in uploaded_files])
+        except OSError as e:
+            st.warning(f"Snapshot non enregistré : {e}")
+        st.session_state["snapshot_upload"] = dataset_key
+else:
+    # Démarrage à chaud : proposer de rouvrir le dernier dataset traité
+    snapshot = utils.snapshot_info()
+    if snapshot is None:
+        st.warning("Veuillez importer le fichier pour commencer.")
+        st.stop()
+
+    st.info(
+        f"Dernier dataset traité : **{', '.join(snapshot['sources'])}** "
+        f"({snapshot['n_rows']:,} lignes, {snapshot['saved_at']})"
+    )
+    if not st.session_state.get("use_snapshot"):
+        if not st.button("⚡ Rouvrir le dernier dataset"):
+            st.warning("Veuillez importer le fichier pour commencer, ou rouvrir le dernier dataset.")
+            st.stop()
+        st.session_state["use_snapshot"] = True
+    df_raw = utils.load_snapshot(snapshot["mtime"])
+    dataset_key = ("snapshot", snapshot["mtime"])
 
 # Filtres de base
 countries = ["Tous"] + sorted(df_raw["Country"].unique())
@@ -44,7 +72,10 @@ date_range = st.sidebar.date_input("Période d'analyse", [min_date, max_date])
 
 # Filtres avancés (regroupés pour nettoyer l'interface)
 with st.sidebar.expander("Options avancées"):
-    returns_mode = st.radio("Retours", ["Inclure", "Exclure", "Neutraliser"], index=1)
+    returns_mode = st.radio(
+        "Retours", ["Inclure", "Exclure", "Neutraliser", "Apparier"], index=1,
+        help="Apparier : chaque retour est déduit de l'achat d'origine (CA net)."
+    )
     
     #  Filtre Type Client
     customer_type = st.selectbox("Type de Client", ["Tous", "B2B (VIP)", "B2C (Standard)"])
@@ -54,23 +85,42 @@ with st.sidebar.expander("Options avancées"):
         min_value=0.0, value=0.0, step=10.0
     )
 
+    # Comptages distincts approximatifs (HyperLogLog) pour l'exploration interactive
+    approx_mode = st.checkbox(
+        "Mode rapide (comptages approximatifs)",
+        help=f"Clients / commandes distincts estimés par HyperLogLog (erreur ≈ ±{sketches.hll_error():.1%}). "
+             "Désactiver pour des chiffres exacts avant export."
+    )
+
 # Badge état des retours
 if returns_mode == "Exclure":
     st.sidebar.markdown("🔵 **Retours exclus**")
 elif returns_mode == "Neutraliser":
     st.sidebar.markdown("🟠 **Retours neutralisés**")
+elif returns_mode == "Apparier":
+    st.sidebar.markdown("🟣 **Retours appariés (CA net)**")
 else:
     st.sidebar.markdown("🟢 Retours inclus")
 
 # Application des filtres
 df = utils.apply_filters(df_raw, country_filter, date_range, returns_mode, order_threshold, customer_type)
+filters = (country_filter, tuple(date_range), returns_mode, order_threshold, customer_type)
 
 if df.empty:
     st.error("Aucune donnée après application des filtres.")
     st.stop()
 
+# Sketches HLL : construits une fois sur tout le dataset (hors filtres pays/dates/type), puis unions
+sketch = None
+if approx_mode:
+    sketch = utils.cached(
+        sketches.build_sketches,
+        utils.apply_filters(df_raw, "Tous", [], returns_mode, order_threshold, "Tous"),
+        dataset_key, ("Tous", (), returns_mode, order_threshold, "Tous")
+    )
+
 # RFM pré-calcul pour être réutilisé sur plusieurs pages
-rfm_base = utils.compute_rfm(df)
+rfm_base = utils.cached(utils.compute_rfm, df, dataset_key, filters)
 rfm_scored = utils.score_rfm(rfm_base)
 
 # Navigation
@@ -85,12 +135,24 @@ filters_text = ( f"Pays={country_filter} | " f"Période={date_range[0]} à {date
 # Pages
 # ---------------------------------------------------------
 
+# Import différé : plotly n'est chargé qu'une fois les données prêtes
+import plotly.express as px
+
 # ---------------- KPIs ----------------
 if page == "KPIs":
     st.subheader("Vue d'ensemble – KPIs")
     
     # Calcul des KPIs via utils
-    ca_total, n_clients, avg_order, north_star, avg_clv_emp = utils.compute_kpis(df)
+    if approx_mode:
+        ca_total, n_clients, avg_order, north_star, avg_clv_emp = sketches.approx_kpis(
+            df, sketch, country_filter, date_range, customer_type
+        )
+        st.caption(
+            f"⚡ Mode rapide : clients et commandes estimés (±{sketches.hll_error():.1%}), "
+            f"North Star estimé sur un échantillon de {sketches.NS_SAMPLE} clients max."
+        )
+    else:
+        ca_total, n_clients, avg_order, north_star, avg_clv_emp = utils.cached(utils.compute_kpis, df, dataset_key, filters)
 
     # CLV baseline théorique (avec hypothèses standard)
     baseline_margin = 0.30   # 30%
@@ -149,6 +211,34 @@ if page == "KPIs":
     png_trend = utils.export_plot_png(fig_trend, filters_text)
     st.download_button( "📥 Télécharger tendance des ventes", data=png_trend, file_name="tendance_vente.png", mime="image/png" )
 
+    # Évolution des KPIs par période (une seule agrégation pour toutes les périodes)
+    st.subheader("Évolution des KPIs")
+    kpi_labels = {
+        "CA": "CA (£)",
+        "Clients_actifs": "Clients actifs",
+        "Panier_moyen": "Panier moyen (£)",
+        "Repeat_pct": "North Star (Repeat %)",
+        "CLV_empirique": "CLV empirique (£)"
+    }
+    window_labels = {"period": "Par période", "expanding": "Cumul depuis le début", "rolling": "Fenêtre glissante"}
+    col_k1, col_k2, col_k3 = st.columns(3)
+    kpi_choice = col_k1.selectbox("Indicateur", list(kpi_labels), format_func=lambda x: kpi_labels[x])
+    window_mode = col_k2.selectbox("Fenêtre", list(window_labels), format_func=lambda x: window_labels[x])
+    n_periods = col_k3.number_input("Taille de la fenêtre (périodes)", min_value=2, max_value=24, value=3,
+                                    disabled=window_mode != "rolling")
+
+    kpi_series = utils.cached(utils.compute_kpi_series, df, dataset_key, filters, granularity, window_mode, int(n_periods))
+    fig_kpi = px.line(
+        kpi_series, x="Period", y=kpi_choice, markers=True,
+        title=f"{kpi_labels[kpi_choice]} – {window_labels[window_mode]} ({format_map[granularity]})",
+        labels={"Period": "Période", kpi_choice: kpi_labels[kpi_choice]}
+    )
+    fig_kpi.add_annotation( text=filters_text, xref="paper", yref="paper", x=0, y=1.12, showarrow=False, align="left", font=dict(size=10, color="gray") )
+    st.plotly_chart(fig_kpi, use_container_width=True)
+    st.session_state["fig_kpi_series"] = fig_kpi
+    png_kpi = utils.export_plot_png(fig_kpi, filters_text)
+    st.download_button( "📥 Télécharger évolution du KPI", data=png_kpi, file_name="evolution_kpi.png", mime="image/png" )
+
 
 # ---------------- Cohortes ----------------
 elif page == "Cohortes":
@@ -164,14 +254,19 @@ elif page == "Cohortes":
         """)
 
     # 1. On récupère les données
-    retention, rev_pivot = utils.compute_cohorts(df)
+    if approx_mode:
+        retention = sketches.approx_retention(sketch, country_filter, date_range, customer_type)
+        st.caption(f"⚡ Mode rapide : rétention estimée (±{sketches.hll_error():.1%}), cohorte = 1er achat sur tout le dataset.")
+    else:
+        retention, rev_pivot = utils.cached(utils.compute_cohorts, df, dataset_key, filters)
     
     # On appelle ta nouvelle fonction pour avoir les détails (densité)
     df_density = utils.get_cohort_data_for_density(df)
 
     # 2. Sélecteur de Focus (Exigence : "possibilité de focus sur une cohorte")
-    if not retention.empty:
-        all_cohorts = sorted([str(c.date()) for c in retention.index], reverse=True)
+    # Cohortes de df_density (1er achat dans la fenêtre filtrée), celles des vues focus, même en mode rapide
+    if not retention.empty and not df_density.empty:
+        all_cohorts = sorted([str(c.date()) for c in df_density["CohortMonth"].unique()], reverse=True)
         focus_cohort = st.selectbox("Focus sur une cohorte spécifique :", ["Toutes"] + all_cohorts)
     else:
         focus_cohort = "Toutes"
@@ -332,6 +427,45 @@ elif page == "RFM":
     else:
         st.warning("Pas de données RFM.")
 
+    # Clusterisation (mini-batch k-means) en complément des segments à règles
+    st.markdown("### Clusterisation RFM (k-means)")
+    if len(rfm_base) < 10:
+        st.info("Pas assez de clients pour la clusterisation.")
+    else:
+        # Le modèle est gardé en session : les changements de filtres réaffectent les clients
+        # aux centroïdes existants, sans ré-apprentissage (sauf demande explicite ou nouveau dataset).
+        refit = st.button("🔄 Ré-entraîner le clustering sur la sélection actuelle")
+        stored = st.session_state.get("rfm_cluster_model")
+        if refit or stored is None or stored["dataset"] != dataset_key:
+            stored = {"dataset": dataset_key, "model": clustering.fit_rfm_clusters(rfm_base, n_jobs=4)}
+            st.session_state["rfm_cluster_model"] = stored
+        cluster_model = stored["model"]
+
+        clusters = clustering.assign_clusters(rfm_base, cluster_model)
+        profiles = clustering.cluster_profiles(rfm_base, clusters)
+        st.caption(
+            f"k = {cluster_model['k']} choisi par silhouette "
+            f"({cluster_model['silhouettes'][cluster_model['k']]:.2f}) – variables log(1+R/F/M) standardisées"
+        )
+        st.dataframe(profiles.style.format({
+            "Recency": "{:.0f} j",
+            "Frequency": "{:.1f}",
+            "Monetary": "{:,.0f} £",
+            "AvgBasket": "{:.2f} £",
+            "Part_clients": "{:.1%}"
+        }))
+
+        fig_clu = px.scatter(
+            profiles, x="Recency", y="Frequency", size="n_clients", color=profiles["Cluster"].astype(str),
+            hover_data=["Monetary", "AvgBasket"], title="Profils des clusters RFM",
+            labels={"Recency": "Recency moyenne (j)", "Frequency": "Frequency moyenne", "color": "Cluster"}
+        )
+        fig_clu.add_annotation( text=filters_text, xref="paper", yref="paper", x=0, y=1.12, showarrow=False, align="left", font=dict(size=10, color="gray") )
+        st.session_state["fig_rfm_clusters"] = fig_clu
+        st.plotly_chart(fig_clu, use_container_width=True)
+        png_clu = utils.export_plot_png(fig_clu, filters_text)
+        st.download_button("📥 Télécharger profils des clusters", data=png_clu, file_name="rfm_clusters.png", mime="image/png")
+
 
 # ---------------- CLV ----------------
 elif page == "CLV":
@@ -346,7 +480,7 @@ elif page == "CLV":
         """)
 
 
-    clv_emp = utils.compute_kpis(df)[4] # On récupère juste la CLV emp
+    clv_emp = utils.cached(utils.compute_kpis, df, dataset_key, filters)[4] # On récupère juste la CLV emp
     st.metric("CLV moyenne empirique", f"{clv_emp:,.2f} £")
 
     st.markdown("### Calculateur CLV (Formule fermée)")
@@ -362,6 +496,53 @@ elif page == "CLV":
     with st.expander("ℹ️ Formule utilisée"):
         st.latex(r"CLV = \frac{m \cdot r}{1 + d - r}")
 
+    # CLV prédictive par client (BG/NBD + Gamma-Gamma ajustés sur la table RFM)
+    st.markdown("### CLV prédictive par client (BG/NBD + Gamma-Gamma)")
+    with st.expander("ℹ️ Aide – Modèles probabilistes"):
+        st.markdown("""
+        - **BG/NBD** : prédit le nombre d'achats futurs d'un client à partir de sa fréquence, de la date de son dernier achat et de son ancienneté, en tenant compte de la probabilité qu'il soit déjà parti (**P(actif)**).
+        - **Gamma-Gamma** : prédit la valeur moyenne de ses prochaines commandes (panier observé, ramené vers la moyenne quand il a peu d'historique).
+        - **CLV prédite** = marge × panier prévu × achats prévus chaque mois, actualisés mois par mois.
+        """)
+
+    if len(rfm_base) < 20:
+        st.info("Pas assez de clients pour ajuster les modèles probabilistes.")
+    else:
+        # Import différé : scipy n'est chargé qu'à l'affichage de la CLV prédictive
+        import clv_models
+        col_p1, col_p2, col_p3 = st.columns(3)
+        horizon = col_p1.slider("Horizon (mois)", 1, 36, clv_models.DEFAULT_HORIZON_MONTHS)
+        margin_pred = col_p2.slider("Marge (%)", 0, 100, int(clv_models.DEFAULT_MARGIN * 100)) / 100
+        disc_pred = col_p3.slider("Actualisation mensuelle (%)", 0.0, 5.0, clv_models.DEFAULT_MONTHLY_DISCOUNT * 100) / 100
+
+        clv_fit = utils.cached(clv_models.fit_clv_models, rfm_base, dataset_key, filters)
+        clv_pred = clv_models.predict_clv(rfm_base, clv_fit, horizon, margin_pred, disc_pred)
+        if not clv_fit["converged"]:
+            st.warning("L'ajustement n'a pas totalement convergé : prédictions à interpréter avec prudence.")
+
+        col_m1, col_m2, col_m3 = st.columns(3)
+        col_m1.metric("CLV prédite moyenne", f"{clv_pred['CLV_predite'].mean():,.2f} £", help=f"Sur {horizon} mois (n={len(clv_pred)})")
+        col_m2.metric("Achats prévus / client", f"{clv_pred['Achats_prevus'].mean():.2f}")
+        col_m3.metric("P(actif) moyenne", f"{clv_pred['P_alive'].mean():.1%}")
+
+        fig_clv_pred = px.histogram(
+            clv_pred, x="CLV_predite", nbins=50, title=f"Distribution de la CLV prédite ({horizon} mois)",
+            labels={"CLV_predite": "CLV prédite (£)"}
+        )
+        fig_clv_pred.update_xaxes(range=[0, clv_pred["CLV_predite"].quantile(0.99)])
+        fig_clv_pred.add_annotation( text=filters_text, xref="paper", yref="paper", x=0, y=1.12, showarrow=False, align="left", font=dict(size=10, color="gray") )
+        st.session_state["fig_clv_pred"] = fig_clv_pred
+        st.plotly_chart(fig_clv_pred, use_container_width=True)
+        png_clv_pred = utils.export_plot_png(fig_clv_pred, filters_text)
+        st.download_button("📥 Télécharger distribution CLV prédite", data=png_clv_pred, file_name="clv_predite.png", mime="image/png")
+
+        st.markdown("**Top 20 clients par CLV prédite**")
+        st.dataframe(clv_pred.nlargest(20, "CLV_predite").style.format({
+            "P_alive": "{:.1%}", "Achats_prevus": "{:.2f}", "Panier_prevu": "{:.2f} £", "CLV_predite": "{:,.2f} £"
+        }))
+        with st.expander("Paramètres ajustés"):
+            st.json({k: {p: round(float(v), 4) for p, v in prm.items()} for k, prm in clv_fit.items() if isinstance(prm, dict)})
+
 
 # ---------------- Scénarios ----------------
 elif page == "Scénarios":
@@ -400,7 +581,7 @@ elif page == "Scénarios":
 
         elif target_mode == "Par Cohorte":
             # Récupérer les mois de cohorte
-            retention_check, _ = utils.compute_cohorts(df)
+            retention_check, _ = utils.cached(utils.compute_cohorts, df, dataset_key, filters)
             cohorts_list = sorted([str(c.date()) for c in retention_check.index], reverse=True)
             selected_cohort = st.selectbox("Choisir la cohorte :", cohorts_list)
             
@@ -509,18 +690,47 @@ elif page == "Export":
     with st.expander("ℹ️ Aide – Export"):
         st.markdown("""
         - **Dataset filtré** : transactions après application des filtres.
-        - **Liste RFM** : CustomerID + segment + métriques clés.
+        - **Liste RFM** : CustomerID + segment + métriques clés + CLV prédite (BG/NBD + Gamma-Gamma, 12 mois).
+        - **CA net par facture** : achats moins retours appariés, par client et facture.
+        - **Rapport groupé** : KPIs, cohortes, RFM et scénario pour chaque pays x type client (ZIP).
         """)
 
     st.markdown("### Export du dataset filtré")
     csv_full = df.to_csv(index=False).encode("utf-8")
     st.download_button("Télécharger le dataset filtré (CSV)", csv_full, "dataset_filtre.csv", "text/csv")
 
+    st.markdown("### Export du CA net (retours appariés)")
+    # Calculé sur les données brutes filtrées pays / dates / type client, retours compris
+    df_net_src = utils.apply_filters(df_raw, country_filter, date_range, "Inclure", 0, customer_type)
+    net_revenue = utils.compute_net_revenue(df_net_src)
+    if not net_revenue.empty:
+        csv_net = net_revenue.to_csv(index=False).encode("utf-8")
+        st.download_button("Télécharger le CA net par facture (CSV)", csv_net, "ca_net_factures.csv", "text/csv")
+        st.caption(f"Retours appariés : {net_revenue['ReturnedAmount'].sum():,.0f} £ sur {net_revenue['GrossAmount'].sum():,.0f} £ de CA brut")
+
     st.markdown("### Export de la liste activable (RFM)")
     if not rfm_scored.empty:
         # Préparation de l'export avec les métriques utiles
         activable = rfm_scored[["CustomerID", "Segment", "Action", "Recency", "Frequency", "Monetary", "AvgBasket"]]
+        # CLV prédictive (hypothèses par défaut de la page CLV)
+        if len(rfm_base) >= 20:
+            import clv_models
+            clv_pred = clv_models.predict_clv(rfm_base, utils.cached(clv_models.fit_clv_models, rfm_base, dataset_key, filters))
+            activable = activable.merge(clv_pred, on="CustomerID", how="left")
         csv_act = activable.to_csv(index=False).encode("utf-8")
         
         st.download_button("Télécharger la liste RFM (CSV)", csv_act, "liste_activable_rfm.csv", "text/csv")
         st.dataframe(activable.head())
+
+    st.markdown("### Rapport groupé (pays x type client)")
+    report_countries = st.multiselect("Pays du rapport", countries, default=["Tous"])
+    report_types = st.multiselect("Types de client", ["B2B (VIP)", "B2C (Standard)"], default=["B2B (VIP)", "B2C (Standard)"])
+    report_formats = st.multiselect("Formats", ["png", "pdf", "svg"], default=["png"])
+    if st.button("Générer le rapport") and report_countries and report_types and report_formats:
+        import reports
+        with st.spinner(f"Rendu de {len(report_countries) * len(report_types)} combinaisons en parallèle..."):
+            report_zip = reports.build_report(
+                df_raw, report_countries, report_types, date_range, returns_mode, order_threshold, report_formats,
+                n_workers=min(reports.APP_MAX_WORKERS, os.cpu_count() or 1)
+            )
+        st.download_button("📥 Télécharger le rapport (ZIP)", report_zip, "rapport_cohortes_rfm.zip", "application/zip")
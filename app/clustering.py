@@ -0,0 +1,163 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------------------------------------------------------
+# Clusterisation RFM (mini-batch k-means, NumPy pur)
+# ---------------------------------------------------------
+# Variables : log(1 + R/F/M) standardisées. Le modèle ajusté (centroïdes + moyenne/écart-type
+# de standardisation) suffit pour affecter de nouveaux clients sans refaire l'apprentissage.
+
+FEATURES = ["Recency", "Frequency", "Monetary"]
+
+
+def rfm_features(rfm, scaler=None):
+    """
+    Transforme la table RFM en matrice (n_clients x 3) log-scalée et standardisée.
+    Si 'scaler' (mean, std) est fourni, on le réutilise (affectation de nouveaux clients).
+    """
+    X = np.log1p(rfm[FEATURES].clip(lower=0).to_numpy(dtype=np.float64))
+    if scaler is None:
+        mean, std = X.mean(axis=0), X.std(axis=0)
+        std[std == 0] = 1.0
+    else:
+        mean, std = scaler
+    return (X - mean) / std, (mean, std)
+
+
+def _sq_distances(X, centroids):
+    """Distances euclidiennes au carré (n x k), vectorisées."""
+    return (
+        (X ** 2).sum(axis=1)[:, None]
+        - 2 * X @ centroids.T
+        + (centroids ** 2).sum(axis=1)[None, :]
+    ).clip(min=0)
+
+
+def _kmeans_pp(X, k, rng):
+    """Initialisation k-means++."""
+    centroids = [X[rng.integers(len(X))]]
+    d2 = _sq_distances(X, np.array(centroids))[:, 0]
+    for _ in range(1, k):
+        probs = d2 / d2.sum() if d2.sum() > 0 else None
+        centroids.append(X[rng.choice(len(X), p=probs)])
+        d2 = np.minimum(d2, _sq_distances(X, centroids[-1][None, :])[:, 0])
+    return np.array(centroids)
+
+
+def _minibatch_run(X, k, batch_size, n_iter, seed):
+    """Une exécution de mini-batch k-means (Sculley, 2010). Retourne (centroïdes, inertie)."""
+    rng = np.random.default_rng(seed)
+    init_idx = rng.choice(len(X), size=min(len(X), max(10 * k, batch_size)), replace=False)
+    centroids = _kmeans_pp(X[init_idx], k, rng)
+    counts = np.zeros(k)
+
+    for _ in range(n_iter):
+        batch = X[rng.integers(len(X), size=min(batch_size, len(X)))]
+        labels = _sq_distances(batch, centroids).argmin(axis=1)
+
+        # Mise à jour agrégée par centre : pas d'apprentissage 1 / effectif cumulé
+        n_b = np.bincount(labels, minlength=k)
+        sums = np.column_stack([np.bincount(labels, weights=batch[:, j], minlength=k) for j in range(X.shape[1])])
+        counts += n_b
+        moved = n_b > 0
+        centroids[moved] += (sums[moved] - n_b[moved, None] * centroids[moved]) / counts[moved, None]
+
+    inertia = _sq_distances(X, centroids).min(axis=1).sum()
+    return centroids, inertia
+
+
+def minibatch_kmeans(X, k, batch_size=1024, n_iter=100, n_init=3, seed=0, n_jobs=1):
+    """
+    Mini-batch k-means vectorisé. Les 'n_init' initialisations tournent en parallèle
+    sur 'n_jobs' threads (NumPy libère le GIL) ; on garde celle de plus faible inertie.
+    """
+    seeds = [seed + i for i in range(n_init)]
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            runs = list(pool.map(lambda s: _minibatch_run(X, k, batch_size, n_iter, s), seeds))
+    else:
+        runs = [_minibatch_run(X, k, batch_size, n_iter, s) for s in seeds]
+    return min(runs, key=lambda run: run[1])[0]
+
+
+def silhouette(X, labels, chunk_size=256):
+    """
+    Score de silhouette moyen (vectorisé, O(n²) : à appeler sur un échantillon).
+    Distances calculées par blocs de 'chunk_size' lignes : mémoire O(chunk_size x n), sans matrice n x n.
+    """
+    k = labels.max() + 1
+    if k < 2 or len(X) < 3:
+        return -1.0
+    sizes = np.bincount(labels, minlength=k)
+    one_hot = np.eye(k)[labels]
+
+    # Somme des distances de chaque point à chaque cluster -> moyennes intra / plus proche voisin
+    sums = np.empty((len(X), k))
+    for start in range(0, len(X), chunk_size):
+        block = slice(start, start + chunk_size)
+        sums[block] = np.sqrt(_sq_distances(X[block], X)) @ one_hot
+
+    own = sizes[labels]
+    a = sums[np.arange(len(X)), labels] / np.maximum(own - 1, 1)
+    mean_other = sums / np.maximum(sizes, 1)
+    mean_other[np.arange(len(X)), labels] = np.inf
+    mean_other[:, sizes == 0] = np.inf
+    b = mean_other.min(axis=1)
+
+    s = (b - a) / np.maximum(a, b)
+    s[own <= 1] = 0
+    return float(s.mean())
+
+
+def fit_rfm_clusters(rfm, k_range=range(2, 9), sample_size=3000, seed=0, n_jobs=1):
+    """
+    Ajuste le clustering RFM et choisit k par silhouette sur un échantillon.
+    Retourne le modèle : {'k', 'centroids', 'scaler', 'silhouettes'}.
+    """
+    X, scaler = rfm_features(rfm)
+    rng = np.random.default_rng(seed)
+    sample = X[rng.choice(len(X), size=min(sample_size, len(X)), replace=False)]
+
+    def fit_k(k):
+        centroids = minibatch_kmeans(X, k, seed=seed)
+        return k, centroids, silhouette(sample, _sq_distances(sample, centroids).argmin(axis=1))
+
+    # Chaque k est indépendant : on les ajuste en parallèle si n_jobs > 1 (plafonné au nombre de cœurs)
+    ks = [k for k in k_range if k < len(sample)]
+    n_jobs = min(n_jobs, os.cpu_count() or 1)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            fits = list(pool.map(fit_k, ks))
+    else:
+        fits = [fit_k(k) for k in ks]
+
+    silhouettes = {k: score for k, _, score in fits}
+    best = max(fits, key=lambda fit: fit[2], default=None)
+
+    if best is None:
+        return None
+
+    # Ordre stable des clusters : du plus fort Monetary moyen au plus faible
+    k, centroids, _ = best
+    centroids = centroids[np.argsort(-centroids[:, FEATURES.index("Monetary")])]
+    return {"k": k, "centroids": centroids, "scaler": scaler, "silhouettes": silhouettes}
+
+
+def assign_clusters(rfm, model):
+    """Affecte chaque client au centroïde le plus proche (sans ré-apprentissage)."""
+    X, _ = rfm_features(rfm, scaler=model["scaler"])
+    return _sq_distances(X, model["centroids"]).argmin(axis=1)
+
+
+def cluster_profiles(rfm, labels):
+    """Profil moyen (R, F, M, panier) et effectif de chaque cluster."""
+    profiles = rfm.assign(Cluster=labels).groupby("Cluster").agg(
+        n_clients=("CustomerID", "count"),
+        Recency=("Recency", "mean"),
+        Frequency=("Frequency", "mean"),
+        Monetary=("Monetary", "mean"),
+        AvgBasket=("AvgBasket", "mean")
+    ).reset_index()
+    profiles["Part_clients"] = profiles["n_clients"] / profiles["n_clients"].sum()
+    return profiles
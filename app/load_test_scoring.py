@@ -0,0 +1,94 @@
+"""
+Test de charge du service de scoring (scoring_service.py).
+
+Envoie des lectures unitaires (GET /customers/<id>) ou par lot (POST /customers/batch)
+depuis plusieurs threads, sur des connexions keep-alive, et affiche débit et latences.
+
+    python app/load_test_scoring.py --duration 10 --threads 8
+    python app/load_test_scoring.py --batch 100
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+
+import numpy as np
+
+
+def fetch_ids(host, port, limit):
+    """Récupère un échantillon de CustomerID connus du service."""
+    conn = http.client.HTTPConnection(host, port)
+    conn.request("GET", f"/customers?limit={limit}")
+    ids = json.loads(conn.getresponse().read())["ids"]
+    conn.close()
+    return ids
+
+
+def worker(host, port, ids, batch, deadline, latencies, errors):
+    """Boucle de requêtes jusqu'à 'deadline' ; enregistre la latence de chaque requête."""
+    conn = http.client.HTTPConnection(host, port)
+    local = []
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if batch > 1:
+                body = json.dumps({"ids": random.sample(ids, min(batch, len(ids)))})
+                conn.request("POST", "/customers/batch", body=body, headers={"Content-Type": "application/json"})
+            else:
+                conn.request("GET", f"/customers/{random.choice(ids)}")
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection(host, port)
+            continue
+        local.append(time.perf_counter() - start)
+    conn.close()
+    latencies.extend(local)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge du service de scoring")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="Durée du test (s)")
+    parser.add_argument("--batch", type=int, default=1, help="Taille de lot (1 = lecture unitaire)")
+    parser.add_argument("--n-ids", type=int, default=5000, help="Nombre de CustomerID échantillonnés")
+    args = parser.parse_args()
+
+    ids = fetch_ids(args.host, args.port, args.n_ids)
+    if not ids:
+        print("Aucun client indexé : test annulé.")
+        return
+
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(args.host, args.port, ids, args.batch, deadline, latencies, errors))
+        for _ in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    lat_ms = np.array(latencies) * 1000
+    n = len(lat_ms)
+    print(f"Requêtes     : {n} en {elapsed:.1f} s ({args.threads} threads, lot = {args.batch})")
+    print(f"Débit        : {n / elapsed:,.0f} req/s ({n * args.batch / elapsed:,.0f} clients/s)")
+    if n:
+        print(f"Latence (ms) : p50 = {np.percentile(lat_ms, 50):.3f} | "
+              f"p95 = {np.percentile(lat_ms, 95):.3f} | p99 = {np.percentile(lat_ms, 99):.3f}")
+    print(f"Erreurs      : {len(errors)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Génération groupée du rapport mensuel (tous pays x types de client), sans passer par l'UI.
+
+Chaque combinaison de filtres est traitée par un worker (processus) : calcul des KPI, cohortes,
+RFM et scénario, construction des figures Plotly puis rastérisation Kaleido. Le dataset n'est
+envoyé qu'une fois par worker (initializer), le temps total baisse donc avec le nombre de cœurs.
+
+    python app/reports.py data/raw/online_retail_II.xlsx --countries "United Kingdom" France --workers 4
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import plotly.express as px
+import plotly.io as pio
+
+import utils
+
+CUSTOMER_TYPES = ["B2B (VIP)", "B2C (Standard)"]
+
+# Plafond de workers depuis l'app : chaque worker reçoit une copie du dataset et lance son Chrome
+APP_MAX_WORKERS = 4
+
+# Hypothèses par défaut de la page Scénarios
+DEFAULT_SCENARIO = {
+    "margin_pct": 0.40,
+    "base_r": 0.60,
+    "base_d": 0.10,
+    "remise_pct": 0.0,
+    "impact_retention": 0.05,
+}
+
+# Dataset partagé par les workers (chargé une fois par processus)
+_WORKER_DF = None
+
+
+def _init_worker(df):
+    global _WORKER_DF
+    _WORKER_DF = df
+    # Un navigateur Kaleido persistant par worker (sinon un Chrome est lancé à chaque image)
+    import kaleido
+    kaleido.start_sync_server(silence_warnings=True)
+
+
+def _annotate(fig, filters_text):
+    fig.add_annotation( text=filters_text, xref="paper", yref="paper", x=0, y=1.12, showarrow=False, align="left", font=dict(size=10, color="gray") )
+    return fig
+
+
+def build_figures(df, filters_text, scenario=DEFAULT_SCENARIO):
+    """
+    Figures du rapport pour un dataset déjà filtré (mêmes graphiques que les pages de l'app).
+    Retourne ({nom_fichier: figure}, ligne de KPI).
+    """
+    figures = {}
+    ca_total, n_clients, avg_order, north_star, clv_emp = utils.compute_kpis(df)
+    kpis = {
+        "CA_total": ca_total, "Clients_actifs": n_clients, "Panier_moyen": avg_order,
+        "Repeat_pct": north_star, "CLV_empirique": clv_emp
+    }
+
+    # KPIs : tendance mensuelle du CA
+    df_trend = df.set_index("InvoiceDate").resample("MS")["Amount"].sum().reset_index()
+    figures["tendance_vente"] = _annotate(px.line(df_trend, x="InvoiceDate", y="Amount", title="Évolution du CA"), filters_text)
+
+    # Cohortes : heatmap de rétention
+    retention, _ = utils.compute_cohorts(df)
+    if not retention.empty:
+        fig_ret = px.imshow(
+            (retention * 100).round(1),
+            labels=dict(x="Mois après acquisition", y="Cohorte", color="Rétention (%)"),
+            aspect="auto", text_auto=".1f", color_continuous_scale="Blues", title="Rétention par cohorte"
+        )
+        figures["cohortes_heatmap"] = _annotate(fig_ret, filters_text)
+
+    # RFM : CA et effectifs par segment
+    rfm_scored = utils.score_rfm(utils.compute_rfm(df))
+    if not rfm_scored.empty:
+        seg_agg = rfm_scored.groupby("Segment").agg(
+            n_clients=("CustomerID", "count"),
+            CA_total=("Monetary", "sum")
+        ).reset_index().sort_values("CA_total", ascending=False)
+        figures["rfm_ca_segment"] = _annotate(
+            px.bar(seg_agg, x="Segment", y="CA_total", text="n_clients", title="CA Total par Segment"), filters_text
+        )
+        figures["rfm_repartition"] = _annotate(
+            px.pie(seg_agg, values="n_clients", names="Segment", title="Répartition des Clients"), filters_text
+        )
+
+    # Scénario : CLV baseline vs scénario (hypothèses par défaut de la page Scénarios)
+    m_base = avg_order * scenario["margin_pct"]
+    m_scen = avg_order * scenario["margin_pct"] * (1 - scenario["remise_pct"] / 100)
+    scen_r = min(0.99, scenario["base_r"] + scenario["impact_retention"])
+    clv_base = utils.clv_formula(m_base, scenario["base_r"], scenario["base_d"])
+    clv_scen = utils.clv_formula(m_scen, scen_r, scenario["base_d"])
+    kpis.update({"CLV_baseline": clv_base, "CLV_scenario": clv_scen})
+    figures["scenario_clv"] = _annotate(
+        px.bar(x=["Baseline", "Scénario"], y=[clv_base, clv_scen], color=["Baseline", "Scénario"],
+               title="Comparaison de la Valeur Vie Client (CLV)", text_auto=".2f"),
+        filters_text
+    )
+
+    return figures, kpis
+
+
+def _render_combo(task):
+    """Travail d'un worker : filtre, calcule, rastérise. Retourne (fichiers, ligne KPI)."""
+    country, customer_type, date_range, returns_mode, order_threshold, formats = task
+    df = utils.apply_filters(_WORKER_DF, country, date_range, returns_mode, order_threshold, customer_type)
+    folder = f"{country}_{customer_type}".replace(" ", "_").replace("(", "").replace(")", "")
+    kpi_row = {"Pays": country, "Type_client": customer_type}
+    if df.empty:
+        return [], kpi_row
+
+    filters_text = f"Pays={country} | Retours={returns_mode} | Type Client={customer_type} | Seuil={order_threshold}£"
+    figures, kpis = build_figures(df, filters_text)
+    kpi_row.update(kpis)
+
+    files = []
+    for name, fig in figures.items():
+        for fmt in formats:
+            files.append((f"{folder}/{name}.{fmt}", pio.to_image(fig, format=fmt, engine="kaleido")))
+    return files, kpi_row
+
+
+def build_report(df, countries, customer_types=CUSTOMER_TYPES, date_range=(), returns_mode="Exclure",
+                 order_threshold=0, formats=("png",), n_workers=None):
+    """
+    Rapport groupé : une série de figures par (pays x type client), rendue en parallèle
+    sur 'n_workers' processus. Retourne le ZIP (bytes) : figures par dossier + kpis.csv.
+    'formats' accepte les formats Kaleido, par ex. ("png", "pdf").
+    Les workers ne reçoivent que les lignes des pays demandés (tout le dataset si "Tous" en fait partie).
+    """
+    if "Tous" not in countries:
+        df = df[df["Country"].isin(countries)]
+    tasks = [
+        (country, customer_type, tuple(date_range), returns_mode, order_threshold, tuple(formats))
+        for country in countries for customer_type in customer_types
+    ]
+    n_workers = n_workers or os.cpu_count() or 1
+
+    # 'spawn' : un fork du serveur Streamlit (multi-thread) peut bloquer sur un verrou hérité
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks)), mp_context=spawn,
+                             initializer=_init_worker, initargs=(df,)) as pool:
+        results = list(pool.map(_render_combo, tasks))
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for files, _ in results:
+            for path, data in files:
+                zf.writestr(path, data)
+        kpi_table = pd.DataFrame([kpi_row for _, kpi_row in results])
+        zf.writestr("kpis.csv", kpi_table.to_csv(index=False))
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Génération groupée du rapport (pays x type client)")
+    parser.add_argument("files", nargs="+", help="Fichiers Online Retail II (.csv / .xlsx)")
+    parser.add_argument("--countries", nargs="*", help="Pays à inclure (défaut : tous + 'Tous')")
+    parser.add_argument("--returns", default="Exclure", choices=["Inclure", "Exclure", "Neutraliser", "Apparier"])
+    parser.add_argument("--formats", nargs="+", default=["png"], help="Formats d'image (png, pdf, svg...)")
+    parser.add_argument("--workers", type=int, default=None, help="Nombre de workers (défaut : nb de cœurs)")
+    parser.add_argument("--output", default="rapport.zip")
+    args = parser.parse_args()
+
+    files = [open(path, "rb") for path in args.files]
+    try:
+        df = utils.load_data(files)
+    finally:
+        for f in files:
+            f.close()
+
+    countries = args.countries or ["Tous"] + sorted(df["Country"].unique())
+    start = time.perf_counter()
+    report = build_report(df, countries, returns_mode=args.returns, formats=args.formats, n_workers=args.workers)
+    with open(args.output, "wb") as f:
+        f.write(report)
+    print(f"Rapport : {len(countries) * len(CUSTOMER_TYPES)} combinaisons en {time.perf_counter() - start:.1f} s -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
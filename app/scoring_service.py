@@ -0,0 +1,301 @@
+"""
+Service HTTP local de scoring client (indépendant de l'interface Streamlit).
+
+Charge les fichiers Online Retail II, calcule la table RFM scorée et la garde en mémoire
+dans un index CustomerID -> fiche client. Un thread surveille les fichiers sources et
+relance le scoring en arrière-plan quand ils changent ; l'index est remplacé d'un bloc,
+les requêtes en cours ne voient jamais un état partiel.
+
+Lancement :
+    python app/scoring_service.py data/raw/online_retail_II.csv --port 8765
+
+Endpoints :
+    GET  /health                 -> état du service (nb clients, date du scoring)
+    GET  /customers?limit=N      -> liste de CustomerID (N premiers)
+    GET  /customers/<id>         -> fiche d'un client
+    POST /customers/batch        -> {"ids": [...]} -> fiches de plusieurs clients
+    POST /score                  -> {"customers": [{"CustomerID", "Recency", "Frequency", "Monetary"}, ...]}
+                                    score les clients nouveaux / mis à jour contre les bornes courantes
+
+Les bornes de quintiles R/F/M viennent de sketches KLL alimentés au fil des /score ;
+un rééquilibrage exact (score_rfm sur tout l'index, comme l'export de l'app) a lieu
+périodiquement et à chaque rescoring.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+import utils
+import sketches
+
+# Hypothèses CLV baseline (identiques à la page KPIs)
+BASELINE_MARGIN = 0.30
+BASELINE_R = 0.60
+BASELINE_D = 0.10
+
+# Bornes relues dans les sketches tous les N clients scorés via /score
+CUTS_REFRESH_EVERY = 1000
+
+EXPORT_COLUMNS = ["Segment", "Action", "R_score", "F_score", "M_score",
+                  "Recency", "Frequency", "Monetary", "AvgBasket", "CLV"]
+
+
+def score_files(paths):
+    """Pipeline complet fichiers -> table RFM scorée avec CLV baseline par client."""
+    files = [open(path, "rb") for path in paths]
+    try:
+        df = utils.load_data(files)
+    finally:
+        for f in files:
+            f.close()
+
+    df = utils.apply_filters(df, "Tous", [], "Exclure", 0, "Tous")
+    rfm_scored = utils.score_rfm(utils.compute_rfm(df))
+    if rfm_scored.empty:
+        return rfm_scored
+
+    rfm_scored["CLV"] = utils.clv_formula(rfm_scored["AvgBasket"] * BASELINE_MARGIN, BASELINE_R, BASELINE_D)
+    return rfm_scored
+
+
+def build_index(rfm_scored):
+    """Index en mémoire : CustomerID -> fiche client (dict prêt à sérialiser)."""
+    if rfm_scored.empty:
+        return {}
+    records = rfm_scored[["CustomerID"] + EXPORT_COLUMNS].astype(
+        {"R_score": "Int64", "F_score": "Int64", "M_score": "Int64"}
+    )
+    records = records.astype(object).where(records.notna(), None)
+    return {row["CustomerID"]: row for row in records.to_dict(orient="records")}
+
+
+class ScoringState:
+    """Index courant + rescoring en arrière-plan quand les fichiers sources changent."""
+
+    def __init__(self, paths, poll_seconds=30, rebalance_seconds=3600):
+        self.paths = paths
+        self.poll_seconds = poll_seconds
+        self.rebalance_seconds = rebalance_seconds
+        self.index = {}
+        self.scored_at = None
+        self.cuts = None
+        self.rfm_sketches = None
+        self._pending = 0
+        self._dirty = False
+        self._last_rebalance = time.monotonic()
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._stop = threading.Event()
+
+    def _current_mtimes(self):
+        return tuple(os.path.getmtime(path) for path in self.paths)
+
+    def refresh(self):
+        """Recalcule l'index si les fichiers ont changé. Retourne True si rescoring."""
+        mtimes = self._current_mtimes()
+        if mtimes == self._mtimes:
+            return False
+        rfm_scored = score_files(self.paths)
+        index = build_index(rfm_scored)
+        with self._lock:
+            # Remplacement atomique de la référence : pas de verrou côté lecture
+            self.index = index
+            self._reset_cuts(rfm_scored)
+        self.scored_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._mtimes = mtimes
+        return True
+
+    def _reset_cuts(self, rfm):
+        """Bornes exactes + sketches repartis de zéro (appelé sous verrou)."""
+        if rfm.empty:
+            self.cuts, self.rfm_sketches = None, None
+        else:
+            self.cuts = utils.rfm_cut_points(rfm)
+            self.rfm_sketches = sketches.build_rfm_sketches(rfm)
+        self._pending = 0
+        self._dirty = False
+        self._last_rebalance = time.monotonic()
+
+    def score_customers(self, customers):
+        """
+        Score des clients nouveaux / mis à jour contre les bornes courantes (O(1) par client),
+        alimente les sketches et met à jour l'index.
+        """
+        rfm = pd.DataFrame(customers, columns=["CustomerID", "Recency", "Frequency", "Monetary"])
+        values = rfm[sketches.RFM_COLUMNS].apply(pd.to_numeric, errors="coerce")
+        invalid = rfm["CustomerID"].isna() | values.isna().any(axis=1) | (values["Frequency"] < 0)
+        if invalid.any():
+            raise ValueError(
+                f"CustomerID, Recency, Frequency et Monetary numériques requis (Frequency ≥ 0) : "
+                f"{invalid.sum()} client(s) invalide(s), ex. {customers[int(invalid.to_numpy().argmax())]}"
+            )
+        rfm[sketches.RFM_COLUMNS] = values
+        rfm["CustomerID"] = rfm["CustomerID"].astype(str)
+        rfm["AvgBasket"] = rfm["Monetary"] / rfm["Frequency"].where(rfm["Frequency"] > 0)
+
+        with self._lock:
+            if self.cuts is None:
+                raise ValueError("Aucune borne RFM disponible : index vide")
+            for col in sketches.RFM_COLUMNS:
+                self.rfm_sketches[col].update(rfm[col].to_numpy())
+            self._pending += len(rfm)
+            self._dirty = True
+            if self._pending >= CUTS_REFRESH_EVERY:
+                self.cuts = sketches.sketch_rfm_cut_points(self.rfm_sketches)
+                self._pending = 0
+            cuts = self.cuts
+
+        rfm_scored = utils.score_rfm_with_cuts(rfm, cuts)
+        rfm_scored["CLV"] = utils.clv_formula(rfm_scored["AvgBasket"] * BASELINE_MARGIN, BASELINE_R, BASELINE_D)
+        records = build_index(rfm_scored)
+        with self._lock:
+            # Copie puis remplacement : les lectures sans verrou ne voient jamais un dict en cours de modification
+            index = dict(self.index)
+            index.update(records)
+            self.index = index
+        return records
+
+    def rebalance(self):
+        """
+        Rééquilibrage exact : re-scoring de tout l'index avec score_rfm (mêmes segments que
+        l'export de l'app), puis bornes et sketches repartis de zéro. Sous verrou de bout en
+        bout, pour ne perdre aucun /score arrivé pendant le calcul.
+        """
+        with self._lock:
+            if not self.index:
+                return
+            rfm = pd.DataFrame(list(self.index.values()))[["CustomerID", "Recency", "Frequency", "Monetary", "AvgBasket", "CLV"]]
+            # Même ordre que compute_rfm : score_rfm départage les ex-aequo par ordre d'apparition
+            rfm = rfm.sort_values("CustomerID", kind="stable").reset_index(drop=True)
+            self._reset_cuts(rfm)
+            self.index = build_index(utils.score_rfm(rfm))
+
+    def watch(self):
+        """Boucle de surveillance (thread démon)."""
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                if self.refresh():
+                    print(f"[scoring] Rescoring terminé : {len(self.index)} clients ({self.scored_at})")
+                elif self._dirty and time.monotonic() - self._last_rebalance > self.rebalance_seconds:
+                    self.rebalance()
+                    print(f"[scoring] Rééquilibrage exact des bornes RFM ({len(self.index)} clients)")
+            except Exception as e:
+                print(f"[scoring] Échec du rescoring, index précédent conservé : {e}")
+
+    def start_watcher(self):
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def make_handler(state):
+    """Construit le handler HTTP lié à l'état de scoring."""
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 : connexions keep-alive, indispensable pour la latence
+        protocol_version = "HTTP/1.1"
+        # En-têtes et corps envoyés séparément : sans TCP_NODELAY, Nagle ajoute ~40 ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split("/") if p]
+
+            if parts == ["health"]:
+                self._send_json({"status": "ok", "n_customers": len(state.index), "scored_at": state.scored_at})
+            elif parts == ["customers"]:
+                try:
+                    limit = int(parse_qs(url.query).get("limit", ["100"])[0])
+                except ValueError:
+                    self._send_json({"error": "Paramètre 'limit' invalide, entier attendu"}, status=400)
+                    return
+                self._send_json({"ids": list(state.index)[:limit]})
+            elif len(parts) == 2 and parts[0] == "customers":
+                record = state.index.get(parts[1])
+                if record is None:
+                    self._send_json({"error": f"Client {parts[1]} inconnu"}, status=404)
+                else:
+                    self._send_json(record)
+            else:
+                self._send_json({"error": "Route inconnue"}, status=404)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_POST(self):
+            route = urlparse(self.path).path.rstrip("/")
+            if route == "/score":
+                try:
+                    customers = self._read_json()["customers"]
+                    records = state.score_customers(customers)
+                except (ValueError, KeyError, TypeError) as e:
+                    self._send_json({"error": f"Requête /score invalide : {e}"}, status=400)
+                    return
+                self._send_json({"results": records})
+                return
+
+            if route != "/customers/batch":
+                self._send_json({"error": "Route inconnue"}, status=404)
+                return
+            try:
+                ids = self._read_json().get("ids", [])
+                if not isinstance(ids, list):
+                    raise TypeError("'ids' doit être une liste")
+            except (ValueError, AttributeError, TypeError):
+                self._send_json({"error": "Corps JSON invalide, attendu {\"ids\": [...]}"}, status=400)
+                return
+
+            index = state.index
+            results = {str(i): index[str(i)] for i in ids if str(i) in index}
+            missing = [str(i) for i in ids if str(i) not in index]
+            self._send_json({"results": results, "missing": missing})
+
+    return ScoringHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Service local de scoring RFM / CLV")
+    parser.add_argument("files", nargs="+", help="Fichiers Online Retail II (.csv / .xlsx)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--poll", type=int, default=30, help="Intervalle de surveillance des fichiers (s)")
+    parser.add_argument("--rebalance", type=int, default=3600, help="Intervalle du rééquilibrage exact des bornes (s)")
+    args = parser.parse_args()
+
+    state = ScoringState(args.files, poll_seconds=args.poll, rebalance_seconds=args.rebalance)
+    state.refresh()
+    print(f"[scoring] {len(state.index)} clients indexés ({state.scored_at})")
+    state.start_watcher()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"[scoring] Service disponible sur http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import pandas as pd
+import numpy as np
+
+# ---------------------------------------------------------
+# Comptages distincts approximatifs (HyperLogLog)
+# ---------------------------------------------------------
+# Un sketch HLL par cellule (jour, pays, cohorte, type client) pour CustomerID et InvoiceNo.
+# L'union de deux sketches = max registre par registre, donc n'importe quelle combinaison
+# de filtres se calcule par union des cellules sélectionnées, sans repasser sur les lignes.
+#
+# Erreur relative (écart-type) : 1.04 / sqrt(2^p)
+#   p = 10 -> ~3.3 %   |   p = 12 -> ~1.6 %   |   p = 14 -> ~0.8 %
+# Les exports et chiffres officiels doivent rester en mode exact (nunique).
+
+HLL_P = 10
+
+# North Star (clients à ≥ 2 commandes) : non dérivable d'un HLL. On garde un échantillon coordonné
+# (les NS_SAMPLE clients de plus petit hash, les mêmes dans toutes les cellules) avec leurs
+# factures distinctes par cellule. Erreur ≈ sqrt(p(1-p)/n) sur les n clients échantillonnés de la sélection.
+NS_SAMPLE = 4096
+
+
+def hll_error(p=HLL_P):
+    """Erreur relative standard d'un sketch HLL à 2^p registres."""
+    return 1.04 / np.sqrt(2 ** p)
+
+
+def _leading_zeros(x):
+    """Nombre de zéros en tête sur 64 bits (vectorisé, recherche dichotomique)."""
+    x = x.astype(np.uint64)
+    n = np.zeros(len(x), dtype=np.uint8)
+    for s in (32, 16, 8, 4, 2, 1):
+        cond = (x >> np.uint64(64 - s)) == 0
+        n += np.where(cond, s, 0).astype(np.uint8)
+        x = np.where(cond, x << np.uint64(s), x)
+    n += (x == 0).astype(np.uint8)
+    return n
+
+
+def _registers(values, cells, n_cells, p):
+    """Construit la matrice de registres (n_cells x 2^p) pour une colonne de valeurs."""
+    h = pd.util.hash_array(np.asarray(values, dtype=object))
+    idx = (h >> np.uint64(64 - p)).astype(np.int64)
+    rest = h << np.uint64(p)
+    # Rang = position du 1er bit à 1 dans les 64-p bits restants (plafonné)
+    rank = np.minimum(_leading_zeros(rest) + 1, 64 - p + 1).astype(np.uint8)
+
+    regs = np.zeros((n_cells, 2 ** p), dtype=np.uint8)
+    np.maximum.at(regs, (cells, idx), rank)
+    return regs
+
+
+def hll_estimate(registers):
+    """Estimation HLL (avec correction petites cardinalités) à partir d'un vecteur de registres."""
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zeros = np.count_nonzero(registers == 0)
+    if raw <= 2.5 * m and zeros > 0:
+        return m * np.log(m / zeros)
+    return raw
+
+
+def hll_union(registers):
+    """Fusionne plusieurs sketches (lignes d'une matrice) en un seul."""
+    if len(registers) == 0:
+        return np.zeros(registers.shape[1], dtype=np.uint8)
+    return registers.max(axis=0)
+
+
+def build_sketches(df, p=HLL_P):
+    """
+    Construit les sketches HLL par cellule (Day, Country, CohortMonth, CustomerType).
+    La cohorte est le mois de 1er achat sur tout le dataset fourni (pas sur la fenêtre filtrée).
+    Retourne un dict : 'cells' (DataFrame), 'customers' et 'invoices' (matrices de registres), 'p'.
+    """
+    if df.empty:
+        return {"cells": pd.DataFrame(), "customers": np.zeros((0, 2 ** p), dtype=np.uint8),
+                "invoices": np.zeros((0, 2 ** p), dtype=np.uint8), "p": p,
+                "repeat_sample": pd.DataFrame(columns=["cell", "CustomerID", "InvoiceNo"])}
+
+    cohort = df.groupby("CustomerID")["InvoiceMonth"].transform("min")
+    customer_type = np.where(df["CustomerID"].astype(int) < 13000, "B2B (VIP)", "B2C (Standard)")
+    keys = pd.DataFrame({
+        "Day": df["InvoiceDate"].dt.normalize(),
+        "Country": df["Country"],
+        "CohortMonth": cohort,
+        "CustomerType": customer_type
+    }, index=df.index)
+
+    grouped = keys.groupby(list(keys.columns), sort=True)
+    cells_code = grouped.ngroup().to_numpy()
+    cells = grouped.size().reset_index()[list(keys.columns)]
+    cells["Month"] = cells["Day"].dt.to_period("M").dt.to_timestamp()
+
+    # Échantillon North Star : couples (cellule, client, facture) distincts des clients échantillonnés
+    customer_ids = df["CustomerID"].unique()
+    hashes = pd.util.hash_array(np.asarray(customer_ids, dtype=object))
+    sampled = customer_ids[np.argsort(hashes)[:NS_SAMPLE]]
+    in_sample = df["CustomerID"].isin(sampled).to_numpy()
+    repeat_sample = pd.DataFrame({
+        "cell": cells_code[in_sample],
+        "CustomerID": df["CustomerID"].to_numpy()[in_sample],
+        "InvoiceNo": df["InvoiceNo"].to_numpy()[in_sample]
+    }).drop_duplicates(ignore_index=True)
+
+    return {
+        "cells": cells,
+        "customers": _registers(df["CustomerID"], cells_code, len(cells), p),
+        "invoices": _registers(df["InvoiceNo"].astype(str), cells_code, len(cells), p),
+        "p": p,
+        "repeat_sample": repeat_sample
+    }
+
+
+def select_cells(sketch, country_filter="Tous", date_range=(), customer_type="Tous"):
+    """Masque booléen des cellules correspondant aux filtres globaux (mêmes règles que apply_filters)."""
+    cells = sketch["cells"]
+    mask = np.ones(len(cells), dtype=bool)
+    if cells.empty:
+        return mask
+
+    if country_filter != "Tous":
+        mask &= (cells["Country"] == country_filter).to_numpy()
+    if len(date_range) == 2:
+        start, end = date_range
+        # apply_filters garde InvoiceDate <= end à minuit : le jour 'end' lui-même est exclu
+        mask &= ((cells["Day"] >= pd.Timestamp(start)) & (cells["Day"] < pd.Timestamp(end))).to_numpy()
+    if customer_type != "Tous":
+        mask &= (cells["CustomerType"] == customer_type).to_numpy()
+    return mask
+
+
+def approx_distinct(sketch, metric, country_filter="Tous", date_range=(), customer_type="Tous"):
+    """Nombre approximatif de CustomerID ('customers') ou InvoiceNo ('invoices') distincts."""
+    mask = select_cells(sketch, country_filter, date_range, customer_type)
+    if not mask.any():
+        return 0
+    return hll_estimate(hll_union(sketch[metric][mask]))
+
+
+def approx_north_star(sketch, country_filter="Tous", date_range=(), customer_type="Tous"):
+    """% de clients à ≥ 2 commandes, estimé sur l'échantillon coordonné (sans repasser sur les lignes)."""
+    mask = select_cells(sketch, country_filter, date_range, customer_type)
+    sample = sketch["repeat_sample"]
+    sample = sample[mask[sample["cell"].to_numpy()]]
+    if sample.empty:
+        return 0
+    n_invoices = sample.groupby("CustomerID")["InvoiceNo"].nunique()
+    return (n_invoices > 1).mean() * 100
+
+
+def approx_kpis(df, sketch, country_filter="Tous", date_range=(), customer_type="Tous"):
+    """
+    Même sortie que utils.compute_kpis : clients et factures distincts issus des sketches HLL,
+    North Star estimé sur l'échantillon coordonné (approx_north_star).
+    """
+    if df.empty:
+        return 0, 0, 0, 0, 0
+
+    ca_total = df["Amount"].sum()
+    n_clients = approx_distinct(sketch, "customers", country_filter, date_range, customer_type)
+    n_invoices = approx_distinct(sketch, "invoices", country_filter, date_range, customer_type)
+    panier_moyen = ca_total / n_invoices if n_invoices > 0 else 0
+
+    north_star = approx_north_star(sketch, country_filter, date_range, customer_type)
+
+    clv_emp = ca_total / n_clients if n_clients > 0 else 0
+
+    return ca_total, round(n_clients), panier_moyen, north_star, clv_emp
+
+
+def approx_retention(sketch, country_filter="Tous", date_range=(), customer_type="Tous"):
+    """
+    Matrice de rétention (même format que compute_cohorts) par union des sketches
+    de chaque (CohortMonth, mois d'achat).
+    """
+    mask = select_cells(sketch, country_filter, date_range, customer_type)
+    cells = sketch["cells"][mask]
+    if cells.empty:
+        return pd.DataFrame()
+
+    regs = sketch["customers"][mask]
+    rows = []
+    for (cohort, month), pos in cells.groupby(["CohortMonth", "Month"]).indices.items():
+        index = (month.year - cohort.year) * 12 + (month.month - cohort.month)
+        rows.append((cohort, index, hll_estimate(hll_union(regs[pos]))))
+
+    cohort_data = pd.DataFrame(rows, columns=["CohortMonth", "CohortIndex", "CustomerID"])
+    cohort_pivot = cohort_data.pivot_table(index="CohortMonth", columns="CohortIndex", values="CustomerID")
+
+    # Cohortes dont le mois d'acquisition est hors fenêtre : pas de taille de référence
+    if 0 not in cohort_pivot.columns:
+        return pd.DataFrame()
+    cohort_pivot = cohort_pivot[cohort_pivot[0].notna()]
+
+    cohort_sizes = cohort_pivot[0]
+    return cohort_pivot.divide(cohort_sizes, axis=0)
+
+
+# ---------------------------------------------------------
+# Quantiles approximatifs (sketch KLL) pour le scoring RFM incrémental
+# ---------------------------------------------------------
+# Chaque niveau h garde des valeurs de poids 2^h ; quand un niveau déborde, on le trie et on
+# en promeut une valeur sur deux (décalage aléatoire) au niveau supérieur. Deux sketches se
+# fusionnent en concaténant leurs niveaux puis en compactant : on peut donc construire un
+# sketch par pays ou par mois et obtenir les bornes globales par fusion.
+#
+# Erreur de rang typique ≈ 1 / k  (k = 200 -> ~0.5-1 % de rang sur les bornes de quintiles).
+
+KLL_K = 200
+
+
+class KLLSketch:
+    """Sketch de quantiles fusionnable (variante simplifiée de KLL, Karnin-Lang-Liberty 2016)."""
+
+    def __init__(self, k=KLL_K, seed=0):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        # Niveau le plus haut : k ; chaque niveau inférieur : x 2/3
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            buf = self.levels[level]
+            if len(buf) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                buf = np.sort(buf)
+                # Nombre impair : le dernier élément reste à ce niveau
+                even = len(buf) - len(buf) % 2
+                promoted = buf[self._rng.integers(2):even:2]
+                self.levels[level] = buf[even:]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def update(self, values):
+        """Ajoute un lot de valeurs (NaN ignorés)."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Fusionne 'other' dans ce sketch (en place) et le retourne."""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, buf in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], buf])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def quantile(self, qs):
+        """Quantiles approximatifs (qs dans [0, 1])."""
+        values = np.concatenate(self.levels)
+        if len(values) == 0:
+            return np.full(len(np.atleast_1d(qs)), np.nan)
+        weights = np.concatenate([np.full(len(buf), 2.0 ** h) for h, buf in enumerate(self.levels)])
+        order = np.argsort(values)
+        cum = np.cumsum(weights[order])
+        pos = np.searchsorted(cum, np.atleast_1d(qs) * cum[-1], side="left")
+        return values[order][np.minimum(pos, len(values) - 1)]
+
+
+RFM_COLUMNS = ["Recency", "Frequency", "Monetary"]
+
+
+def build_rfm_sketches(rfm, k=KLL_K):
+    """Un sketch KLL par variable R, F, M à partir d'une table compute_rfm."""
+    return {col: KLLSketch(k).update(rfm[col].to_numpy()) for col in RFM_COLUMNS}
+
+
+def merge_rfm_sketches(sketch_list):
+    """Fusionne des sketches RFM (ex. un par pays ou par mois) en un sketch global."""
+    merged = {col: KLLSketch(sketch_list[0][col].k) for col in RFM_COLUMNS}
+    for rfm_sketch in sketch_list:
+        for col in RFM_COLUMNS:
+            merged[col].merge(rfm_sketch[col])
+    return merged
+
+
+def sketch_rfm_cut_points(rfm_sketches):
+    """Bornes des quintiles R, F, M issues des sketches (même format que utils.rfm_cut_points)."""
+    return {col: rfm_sketches[col].quantile([0.2, 0.4, 0.6, 0.8]) for col in RFM_COLUMNS}
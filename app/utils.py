@@ -2,7 +2,14 @@ import pandas as pd
 import numpy as np
 import streamlit as st
 import io
-import plotly.io as pio
+import os
+import json
+import time
+
+# Dernier dataset traité (démarrage à chaud sans ré-upload)
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "processed")
+SNAPSHOT_DATA = os.path.join(SNAPSHOT_DIR, "last_snapshot.pkl")
+SNAPSHOT_META = os.path.join(SNAPSHOT_DIR, "last_snapshot.json")
 
 # ---------------------------------------------------------
 # Chargement des données
@@ -63,9 +70,188 @@ def load_data(uploaded_files):
     # Ajout .upper() pour robustesse sur le 'C'
     df["is_cancel"] = df["InvoiceNo"].astype(str).str.upper().str.startswith("C")
 
+    # Appariement retours -> achats (une seule fois, résultat mis en cache avec le chargement)
+    df = net_returns(df)
+
+    return df
+
+
+def save_snapshot(df, sources):
+    """Enregistre le dataset traité (pickle) et ses métadonnées dans data/processed/."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    # Écriture dans un fichier temporaire puis renommage : pas de snapshot à moitié écrit
+    tmp_path = SNAPSHOT_DATA + ".tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, SNAPSHOT_DATA)
+    meta = {
+        "sources": [os.path.basename(str(source)) for source in sources],
+        "n_rows": len(df),
+        "saved_at": time.strftime("%Y-%m-%d %H:%M")
+    }
+    with open(SNAPSHOT_META, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+def snapshot_info():
+    """Métadonnées du dernier snapshot (+ 'mtime' pour la clé de cache), ou None."""
+    if not (os.path.exists(SNAPSHOT_DATA) and os.path.exists(SNAPSHOT_META)):
+        return None
+    with open(SNAPSHOT_META, encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["mtime"] = os.path.getmtime(SNAPSHOT_DATA)
+    return meta
+
+
+@st.cache_data
+def load_snapshot(mtime):
+    """Recharge le dernier dataset traité ('mtime' invalide le cache si le snapshot change)."""
+    return pd.read_pickle(SNAPSHOT_DATA)
+
+
+# ---------------------------------------------------------
+# Cache des agrégats
+# ---------------------------------------------------------
+# Clé = (fonction, dataset, filtres) et non le DataFrame filtré : au-delà de 50 000 lignes,
+# Streamlit ne hache qu'un échantillon du DataFrame et deux vues de même forme pourraient
+# partager une entrée. Cache mémoire borné en taille et en durée ; le démarrage à chaud
+# repose sur le snapshot (un cache persist="disk" n'applique ni TTL ni limite sur disque).
+
+CACHE_MAX_ENTRIES = 64
+CACHE_TTL = 3600  # secondes
+
+
+def cached(func, df, dataset_key, filters, *args):
+    """
+    func(df, *args) mis en cache. 'dataset_key' identifie le dataset chargé (upload ou snapshot),
+    'filters' les filtres qui ont produit df : ensemble, ils doivent déterminer df entièrement.
+    """
+    return _cached_call(f"{func.__module__}.{func.__qualname__}", dataset_key, tuple(filters), args, func, df)
+
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, show_spinner=False)
+def _cached_call(name, dataset_key, filters, args, _func, _df):
+    # Paramètres préfixés par '_' : exclus du hachage
+    return _func(_df, *args)
+
+
+# ---------------------------------------------------------
+# Appariement des retours
+# ---------------------------------------------------------
+
+def match_returns(df):
+    """
+    Relie chaque ligne d'annulation à l'achat d'origine qu'elle annule.
+    Jointure (hash join) sur CustomerID + StockCode, puis allocation FIFO des quantités :
+    les premières unités retournées sont imputées aux premiers achats, sans jamais
+    imputer un retour à un achat postérieur. Entièrement vectorisé (pas de boucle par ligne).
+    Retourne une ligne par couple (achat, retour) avec la quantité et le montant appariés.
+
+    Un retour supérieur au stock acheté avant lui (achat hors période) n'est apparié qu'à
+    hauteur de ce stock, sans décaler les retours suivants :
+
+    >>> df = pd.DataFrame({"CustomerID": "1", "StockCode": "A", "UnitPrice": 1.0,
+    ...                    "InvoiceNo": ["1", "C2", "3", "C4"], "Quantity": [2, -5, 5, -5],
+    ...                    "InvoiceDate": pd.to_datetime(["2010-01-01", "2010-01-02", "2010-01-03", "2010-01-04"])})
+    >>> df["is_cancel"] = df["InvoiceNo"].str.startswith("C")
+    >>> match_returns(df)[["InvoiceNo", "ReturnInvoice", "MatchedQty"]].values.tolist()
+    [['1', 'C2', 2], ['3', 'C4', 5]]
+    """
+    cols = ["LineID", "CustomerID", "StockCode", "InvoiceNo", "ReturnInvoice",
+            "ReturnDate", "MatchedQty", "MatchedAmount"]
+    if df.empty or "StockCode" not in df.columns:
+        return pd.DataFrame(columns=cols)
+
+    key = ["CustomerID", "StockCode"]
+    fields = key + ["InvoiceNo", "InvoiceDate", "Quantity", "UnitPrice"]
+    is_return = df["is_cancel"] | (df["Quantity"] < 0)
+
+    rets = df.loc[is_return & (df["Quantity"] < 0), fields]
+    if rets.empty:
+        return pd.DataFrame(columns=cols)
+    buys = df.loc[~is_return & (df["Quantity"] > 0), fields].rename_axis("LineID").reset_index()
+
+    # On ne garde que les achats dont la clé apparaît dans un retour (réduit la jointure)
+    ret_keys = pd.MultiIndex.from_frame(rets[key].astype(str))
+    buys = buys[pd.MultiIndex.from_frame(buys[key].astype(str)).isin(ret_keys)]
+
+    # Retours antérieurs au 1er achat de la clé (achat hors période) : ne décalent pas l'allocation
+    first_buy = buys.groupby(key)["InvoiceDate"].min().rename("FirstBuy").reset_index()
+    rets = rets.merge(first_buy, on=key, how="inner")
+    rets = rets[rets["InvoiceDate"] >= rets["FirstBuy"]]
+
+    # Intervalles cumulés de quantités par clé, dans l'ordre chronologique
+    buys = buys.sort_values(key + ["InvoiceDate"], kind="stable")
+    buys["P1"] = buys.groupby(key, sort=False)["Quantity"].cumsum()
+    buys["P0"] = buys["P1"] - buys["Quantity"]
+
+    rets = rets.sort_values(key + ["InvoiceDate"], kind="stable").assign(RetQty=lambda x: -x["Quantity"])
+
+    # Quantité achetée cumulée à la date de chaque retour
+    bought = buys.groupby(key + ["InvoiceDate"], sort=False)["P1"].max().reset_index().sort_values("InvoiceDate")
+    rets = pd.merge_asof(
+        rets.sort_values("InvoiceDate"), bought.rename(columns={"P1": "Bought"}),
+        on="InvoiceDate", by=key, direction="backward"
+    ).sort_values(key + ["InvoiceDate"], kind="stable")
+
+    # Position cumulée plafonnée au stock acheté : R1 = min(R1 précédent + retour, acheté).
+    # L'excédent non apparié (achat hors période) est cumulé à part et ne décale pas les retours suivants
+    cum = rets.groupby(key, sort=False)["RetQty"].cumsum()
+    excess = (cum - rets["Bought"]).clip(lower=0).groupby([rets[k] for k in key], sort=False).cummax()
+    rets["R1"] = cum - excess
+    rets["R0"] = rets.groupby(key, sort=False)["R1"].shift(fill_value=0)
+    rets = rets.rename(columns={"InvoiceNo": "ReturnInvoice", "InvoiceDate": "ReturnDate"})
+
+    pairs = buys.merge(
+        rets[key + ["ReturnInvoice", "ReturnDate", "R0", "R1"]], on=key, how="inner"
+    )
+
+    # Chevauchement des intervalles = quantité allouée
+    overlap = np.minimum(pairs["P1"], pairs["R1"]) - np.maximum(pairs["P0"], pairs["R0"])
+    pairs["MatchedQty"] = overlap
+    pairs = pairs[(overlap > 0) & (pairs["InvoiceDate"] <= pairs["ReturnDate"])]
+    pairs["MatchedAmount"] = pairs["MatchedQty"] * pairs["UnitPrice"]
+
+    return pairs[cols].reset_index(drop=True)
+
+
+def net_returns(df):
+    """
+    Ajoute 'ReturnedQty' et 'NetAmount' à chaque ligne d'achat (montant après retours appariés).
+    Les lignes de retour ont un NetAmount de 0 : leur valeur est déjà déduite de l'achat d'origine.
+    """
+    df = df.copy()
+    alloc = match_returns(df)
+    by_line = alloc.groupby("LineID")[["MatchedQty", "MatchedAmount"]].sum()
+
+    is_return = df["is_cancel"] | (df["Quantity"] < 0)
+    df["ReturnedQty"] = by_line["MatchedQty"].reindex(df.index, fill_value=0)
+    returned_amount = by_line["MatchedAmount"].reindex(df.index, fill_value=0)
+    df["NetAmount"] = df["Amount"].where(~is_return, 0) - returned_amount
+
     return df
 
 
+def compute_net_revenue(df):
+    """
+    CA net par client et par facture (achats moins retours appariés).
+    Format compatible avec compute_rfm / compute_kpis (colonnes InvoiceDate, InvoiceNo, Amount).
+    """
+    if df.empty or "NetAmount" not in df.columns:
+        return pd.DataFrame()
+
+    buys = df[~df["is_cancel"] & (df["Quantity"] > 0)]
+    net = buys.groupby(["CustomerID", "InvoiceNo"]).agg(
+        InvoiceDate=("InvoiceDate", "min"),
+        Country=("Country", "first"),
+        GrossAmount=("Amount", "sum"),
+        Amount=("NetAmount", "sum")
+    ).reset_index()
+    net["ReturnedAmount"] = net["GrossAmount"] - net["Amount"]
+    net["InvoiceMonth"] = net["InvoiceDate"].dt.to_period("M").dt.to_timestamp()
+
+    return net
+
+
 # ---------------------------------------------------------
 # Fonctions métier
 # ---------------------------------------------------------
@@ -101,6 +287,12 @@ def apply_filters(df, country_filter, date_range, returns_mode, order_threshold,
     elif returns_mode == "Neutraliser":
         # On garde les lignes mais on tronque la valeur à 0 minimum
         df_f["Amount"] = df_f["Amount"].clip(lower=0)
+    elif returns_mode == "Apparier":
+        # Chaque achat est net de ses retours appariés ; les lignes de retour disparaissent
+        df_f = df_f[(df_f["Quantity"] > 0) & (~df_f["is_cancel"])]
+        df_f = df_f.assign(Amount=df_f["NetAmount"])
+        # Lignes entièrement retournées : plus de CA, on ne les compte plus comme commande
+        df_f = df_f[df_f["Amount"] > 0]
 
     # Seuil de commande (on peut filtrer sur le montant > seuil)
     if order_threshold > 0:
@@ -131,25 +323,87 @@ def compute_kpis(df):
     return ca_total, n_clients, panier_moyen, north_star, clv_emp
 
 
+def compute_kpi_series(df, freq="M", window="period", n_periods=3):
+    """
+    KPIs de compute_kpis (CA, clients actifs, panier moyen, repeat %, CLV empirique)
+    pour chaque période, en une seule agrégation.
+    - freq : "M" (mois), "Q" (trimestre), "W" (semaine)
+    - window : "period" (période seule), "expanding" (cumul depuis le début),
+      "rolling" (n_periods dernières périodes)
+    On agrège une fois par facture, puis on construit une matrice clients x périodes
+    (nb de factures, CA) : les fenêtres se calculent par sommes cumulées sur cette matrice.
+    """
+    cols = ["Period", "CA", "Clients_actifs", "Panier_moyen", "Repeat_pct", "CLV_empirique"]
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+
+    # Une ligne par (facture, période) : même définition du panier que compute_kpis
+    periods = df["InvoiceDate"].dt.to_period(freq)
+    all_periods = pd.period_range(periods.min(), periods.max())
+    inv = pd.DataFrame({
+        "CustomerID": df["CustomerID"],
+        "InvoiceNo": df["InvoiceNo"],
+        "p_idx": periods.array.asi8 - all_periods[0].ordinal,
+        "Amount": df["Amount"]
+    }).groupby(["InvoiceNo", "p_idx"], sort=False).agg(
+        CustomerID=("CustomerID", "first"), Amount=("Amount", "sum")
+    ).reset_index()
+    p_idx = inv["p_idx"].to_numpy()
+    c_idx, customers = pd.factorize(inv["CustomerID"])
+
+    n_inv = np.zeros((len(customers), len(all_periods)))
+    np.add.at(n_inv, (c_idx, p_idx), 1)
+    revenue = np.bincount(p_idx, weights=inv["Amount"].to_numpy(), minlength=len(all_periods))
+    n_orders = n_inv.sum(axis=0)
+
+    # Fenêtres : sommes cumulées le long de l'axe des périodes
+    if window in ("expanding", "rolling"):
+        cum_inv = n_inv.cumsum(axis=1)
+        cum_rev, cum_orders = revenue.cumsum(), n_orders.cumsum()
+        if window == "rolling":
+            lag = n_periods
+            cum_inv[:, lag:] = cum_inv[:, lag:] - n_inv.cumsum(axis=1)[:, :-lag]
+            cum_rev[lag:] = cum_rev[lag:] - revenue.cumsum()[:-lag]
+            cum_orders[lag:] = cum_orders[lag:] - n_orders.cumsum()[:-lag]
+        n_inv, revenue, n_orders = cum_inv, cum_rev, cum_orders
+
+    n_clients = (n_inv > 0).sum(axis=0)
+    repeat = (n_inv > 1).sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        series = pd.DataFrame({
+            "Period": all_periods.to_timestamp(),
+            "CA": revenue,
+            "Clients_actifs": n_clients,
+            "Panier_moyen": np.where(n_orders > 0, revenue / n_orders, 0),
+            "Repeat_pct": np.where(n_clients > 0, repeat / n_clients * 100, 0),
+            "CLV_empirique": np.where(n_clients > 0, revenue / n_clients, 0)
+        })
+    return series
+
+
 def compute_rfm(df):
     """
     Calcule Recency, Frequency, Monetary par client.
-    Calcule aussi 'AvgBasket' (Panier moyen par client) pour le tableau Segments.
+    Calcule aussi 'AvgBasket' (Panier moyen par client) pour le tableau Segments,
+    et 'Tenure' (jours depuis le 1er achat) pour les modèles CLV probabilistes.
     """
     if df.empty:
         return pd.DataFrame()
 
     NOW = df["InvoiceDate"].max() + pd.Timedelta(days=1)
 
-    rfm = df.groupby("CustomerID").agg({
-        "InvoiceDate": lambda x: (NOW - x.max()).days,
-        "InvoiceNo": "nunique",
-        "Amount": ["sum", "mean"] # On récupère Somme ET Moyenne
-    })
-    
-    # Aplatir les colonnes MultiIndex
-    rfm.columns = ["Recency", "Frequency", "Monetary", "AvgBasket"]
-    rfm = rfm.reset_index()
+    # On récupère Somme ET Moyenne du montant
+    rfm = df.groupby("CustomerID").agg(
+        LastDate=("InvoiceDate", "max"),
+        FirstDate=("InvoiceDate", "min"),
+        Frequency=("InvoiceNo", "nunique"),
+        Monetary=("Amount", "sum"),
+        AvgBasket=("Amount", "mean")
+    )
+    rfm["Recency"] = (NOW - rfm["LastDate"]).dt.days
+    rfm["Tenure"] = (NOW - rfm["FirstDate"]).dt.days
+    rfm = rfm[["Recency", "Frequency", "Monetary", "AvgBasket", "Tenure"]].reset_index()
 
     return rfm
 
@@ -203,35 +457,78 @@ def score_rfm(rfm):
         rfm_scored["Action"] = "N/A"
         return rfm_scored
 
-    # Mapping de segments
-    def label_segment(row):
-        r, f, m = int(row["R_score"]), int(row["F_score"]), int(row["M_score"])
-        if r >= 4 and f >= 4 and m >= 4:
-            return "Champions"
-        elif r >= 4 and f >= 3:
-            return "Fidèles"
-        elif r >= 3 and m >= 3:
-            return "Potentiel"
-        elif r <= 2 and f >= 3:
-            return "À risque"
-        else:
-            return "Autres"
-
-    rfm_scored["Segment"] = rfm_scored.apply(label_segment, axis=1)
+    rfm_scored["Segment"] = label_segments(rfm_scored["R_score"], rfm_scored["F_score"], rfm_scored["M_score"])
     
     # Ajout d'une colonne 'Action' pour l'export "Liste Activable"
-    action_map = {
-        "Champions": "Choyer / Upsell VIP",
-        "Fidèles": "Programme fidélité",
-        "Potentiel": "Offre de bienvenue",
-        "À risque": "Réactivation urgente",
-        "Autres": "Automation email"
-    }
-    rfm_scored["Action"] = rfm_scored["Segment"].map(action_map)
+    rfm_scored["Action"] = rfm_scored["Segment"].map(SEGMENT_ACTIONS)
     
     return rfm_scored
 
 
+# Action recommandée par segment (export "Liste Activable")
+SEGMENT_ACTIONS = {
+    "Champions": "Choyer / Upsell VIP",
+    "Fidèles": "Programme fidélité",
+    "Potentiel": "Offre de bienvenue",
+    "À risque": "Réactivation urgente",
+    "Autres": "Automation email"
+}
+
+
+def label_segments(r_score, f_score, m_score):
+    """Mapping (R, F, M) -> segment, vectorisé (règles évaluées dans l'ordre)."""
+    r = np.asarray(r_score, dtype=int)
+    f = np.asarray(f_score, dtype=int)
+    m = np.asarray(m_score, dtype=int)
+    conditions = [
+        (r >= 4) & (f >= 4) & (m >= 4),
+        (r >= 4) & (f >= 3),
+        (r >= 3) & (m >= 3),
+        (r <= 2) & (f >= 3),
+    ]
+    return np.select(conditions, ["Champions", "Fidèles", "Potentiel", "À risque"], default="Autres")
+
+
+def rfm_cut_points(rfm):
+    """
+    Bornes exactes des quintiles R, F, M (4 seuils par variable).
+    Sert de "rééquilibrage" périodique pour score_rfm_with_cuts.
+    """
+    qs = [0.2, 0.4, 0.6, 0.8]
+    return {col: np.quantile(rfm[col].to_numpy(dtype=np.float64), qs) for col in ["Recency", "Frequency", "Monetary"]}
+
+
+def rfm_scores(recency, frequency, monetary, cuts):
+    """
+    Scores R, F, M (1-5) par recherche dichotomique dans des bornes fixées (4 seuils) :
+    un nouveau client se score en O(1), sans re-trier toute la base.
+    Les ex-aequo à cheval sur plusieurs quintiles (ex. Frequency = 1) prennent le quintile
+    médian de leur plage, là où score_rfm les répartit par ordre d'apparition.
+    """
+    def bucket(col, values):
+        values = np.asarray(values, dtype=np.float64)
+        left = np.searchsorted(cuts[col], values, side="left")
+        right = np.searchsorted(cuts[col], values, side="right")
+        return (left + right) // 2
+
+    # Recency : même sens que pd.qcut (borne droite incluse), 5 = le plus récent
+    r = 5 - np.searchsorted(cuts["Recency"], np.asarray(recency, dtype=np.float64), side="left")
+    return r, bucket("Frequency", frequency) + 1, bucket("Monetary", monetary) + 1
+
+
+def score_rfm_with_cuts(rfm, cuts):
+    """Même sortie que score_rfm, mais contre des bornes de quintiles fournies (exactes ou sketch)."""
+    rfm_scored = rfm.copy()
+    if rfm.empty:
+        return rfm_scored
+
+    r, f, m = rfm_scores(rfm["Recency"], rfm["Frequency"], rfm["Monetary"], cuts)
+    rfm_scored["R_score"], rfm_scored["F_score"], rfm_scored["M_score"] = r, f, m
+    rfm_scored["Segment"] = label_segments(r, f, m)
+    rfm_scored["Action"] = rfm_scored["Segment"].map(SEGMENT_ACTIONS)
+    return rfm_scored
+
+
 def compute_cohorts(df):
     """
     Construit une matrice de rétention par cohortes.
@@ -327,6 +624,9 @@ def export_plot_png(fig, filename, filters_text=""):
                 text=f"{fig.layout.title.text}<br><sup>{filters_text}</sup>"
             )
         )
+    # Import différé : plotly.io / Kaleido ne sont chargés qu'au premier export
+    import plotly.io as pio
+
     buffer = io.BytesIO()
     pio.write_image(fig, buffer, format="png", engine="kaleido")
     buffer.seek(0)